@@ -1,14 +1,90 @@
+import random
 import time
 import sqlalchemy.exc
 import sqlalchemy
+import sqlalchemy.pool
 from sqlalchemy.sql import text
 import os
 import logging
+# set LEDGER_LOG_LEVEL=DEBUG to log every SQL statement;
+# unknown level names fall back to INFO instead of failing the import
+_log_level = os.environ.get('LEDGER_LOG_LEVEL', 'INFO').upper()
+if not isinstance(logging.getLevelName(_log_level), int):
+    _log_level = 'INFO'
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=_log_level,
     format=f'%(asctime)s.%(msecs)03d - {os.getpid()} - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S',
 )
+log = logging.getLogger(__name__)
+
+# SQL shared by Ledger and AsyncLedger.
+# asyncpg prepares statements on the server and can't infer every parameter type,
+# so parameters whose type isn't fixed by the surrounding SQL are CAST explicitly.
+_GET_ALL_ACCOUNT_IDS_SQL = 'SELECT account_id FROM accounts;'
+
+_CREATE_ACCOUNT_SQL = (
+    'WITH a AS (INSERT INTO accounts (name) VALUES (:name) RETURNING account_id) '
+    'INSERT INTO balances (account_id, balance) SELECT account_id, 0 FROM a RETURNING account_id;'
+)
+
+_CREATE_ACCOUNTS_SQL = (
+    'WITH a AS (INSERT INTO accounts (name) '
+    '           SELECT name FROM unnest(CAST(:names AS TEXT[])) WITH ORDINALITY AS n(name, ord) ORDER BY ord '
+    '           RETURNING account_id), '
+    '     b AS (INSERT INTO balances (account_id, balance) SELECT account_id, 0 FROM a RETURNING account_id) '
+    'SELECT account_id FROM b ORDER BY account_id;'
+)
+
+_LOCK_BALANCES_SQL = (
+    'SELECT account_id FROM balances WHERE account_id = ANY(CAST(:account_ids AS INTEGER[])) '
+    'ORDER BY account_id FOR NO KEY UPDATE;'
+)
+
+_TRANSFER_FUNDS_SQL = 'SELECT transfer_funds(:dr, :cr, CAST(:amt AS NUMERIC));'
+
+_TRANSFER_FUNDS_BATCH_SQL = (
+    'WITH t AS (SELECT * FROM unnest(CAST(:drs AS INTEGER[]), CAST(:crs AS INTEGER[]), CAST(:amts AS NUMERIC[])) AS t(dr, cr, amt)), '
+    '     i AS (INSERT INTO transactions (debit_account_id, credit_account_id, amount) SELECT dr, cr, amt FROM t), '
+    '     s AS (SELECT account_id, sum(delta) AS delta '
+    '           FROM (SELECT dr, -amt FROM t UNION ALL SELECT cr, amt FROM t) AS u(account_id, delta) '
+    '           GROUP BY account_id) '
+    'UPDATE balances SET balance = balance + s.delta FROM s WHERE balances.account_id = s.account_id;'
+)
+
+
+# transfer_funds() in services/pg/sql/transfer_funds.sql runs with the same limit
+_BATCH_LOCK_TIMEOUT_SQL = "SET LOCAL lock_timeout = '5s';"
+
+
+def _transfer_columns(transfers):
+    '''
+    Turns a list of (debit_account_id, credit_account_id, amount) tuples
+    into the three arrays bound to _TRANSFER_FUNDS_BATCH_SQL.
+    '''
+    columns = {'drs': [], 'crs': [], 'amts': []}
+    for debit_account_id, credit_account_id, amount in transfers:
+        columns['drs'].append(debit_account_id)
+        columns['crs'].append(credit_account_id)
+        columns['amts'].append(amount)
+    return columns
+
+
+def _is_retryable(e):
+    '''
+    Returns True if the database error `e` aborted a transaction that is safe to simply run again:
+    40001 = serialization_failure, 40P01 = deadlock_detected.
+    Anything else (lost connection, lock timeout, ...) won't succeed on retry.
+    '''
+    return getattr(e.orig, 'pgcode', None) in {'40001', '40P01'}
+
+
+def _backoff(attempt):
+    '''
+    Returns how many seconds to sleep before retry number `attempt`.
+    Full-jitter exponential backoff, capped at 0.5s.
+    '''
+    return random.uniform(0, min(0.5, 0.001 * 2**attempt))
 
 
 class Ledger:
@@ -19,21 +95,42 @@ class Ledger:
 
     def __init__(self, url):
         '''
-        The constructor just creates a connection to the database.
-        The same connection is re-used between all SQL commands,
+        The constructor just creates a pool of connections to the database.
+        Each method checks a connection out of the pool for the duration of a single transaction,
         and the right way to think about a connection is as a single psql process where those commands will be entered.
+        Because no connection is shared between calls, concurrent callers each get their own postgres backend.
+        Transactions run at postgres' default READ COMMITTED isolation level.
+        Transfers take explicit row locks on the balances they change, always in account_id order (see _lock_balances),
+        so a transfer that waits on a lock simply continues once the other transaction commits
+        instead of being aborted with a serialization failure, and transfers between unrelated accounts run in parallel.
         '''
-        self.engine = sqlalchemy.create_engine(url)
-        self.connection = self.engine.connect()
+        self.engine = sqlalchemy.create_engine(
+            url,
+            isolation_level='READ COMMITTED',
+            poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=20,
+            max_overflow=10,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            future=True,
+        )
+        self._account_ids_cache = None
 
     def get_all_account_ids(self):
         '''
         This function is used inside of the random_transfers.py script.
+        The ids are read from the database once and cached on this object;
+        create_account invalidates the cache.
         '''
-        sql = text('SELECT account_id FROM accounts;')
-        logging.debug(sql)
-        results = self.connection.execute(sql)
-        return [row[0] for row in results.all()]
+        if self._account_ids_cache is None:
+            # read-only, so there is nothing to commit
+            with self.engine.connect() as conn:
+                sql = text(_GET_ALL_ACCOUNT_IDS_SQL)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('%s', sql)
+                results = conn.execute(sql)
+                self._account_ids_cache = results.scalars().all()
+        return list(self._account_ids_cache)
 
     def create_account(self, name):
         '''
@@ -41,82 +138,130 @@ class Ledger:
         Because of the FOREIGN KEY constraint on the "balances" table,
         we need to know the "account_id" column of the row we've inserted into "accounts".
         This value is generated for us automatically by the database, and not within python.
-        So we need to query the database after inserting into "accounts" to get the value.
+        So we use INSERT ... RETURNING to get the value back and feed it straight into the "balances" insert,
+        which makes the whole operation a single statement and doesn't rely on names being unique.
+        Returns the new account_id.
         '''
-        with self.connection.begin():
-
-            # insert the name into "accounts"
-            sql = text('INSERT INTO accounts (name) VALUES (:name);')
+        with self.engine.begin() as conn:
+            sql = text(_CREATE_ACCOUNT_SQL)
             sql = sql.bindparams(name=name)
-            logging.debug(sql)
-            self.connection.execute(sql)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('%s', sql)
+            account_id = conn.execute(sql).scalar()
 
-            # get the account_id for the new account
-            sql = text('SELECT account_id FROM accounts WHERE name=:name')
-            sql = sql.bindparams(name=name)
-            logging.debug(sql)
-            results = self.connection.execute(sql)
-            account_id = results.first()[0]
+        self._account_ids_cache = None
+        return account_id
+
+    def create_accounts(self, names):
+        '''
+        Creates one account for every name in `names` and returns their account_ids in the same order.
+        This works just like create_account,
+        except that unnest turns the array of names into rows,
+        so every account is created by a single statement instead of one statement per account.
+        RETURNING doesn't promise any row order, so the names are inserted in ORDINALITY order;
+        the SERIAL ids are then drawn in that order, and sorting the result by account_id restores it.
+        '''
+        names = list(names)
+        if not names:
+            return []
 
-            # add the row into the "balances" table
-            sql = text('INSERT INTO balances VALUES (:account_id, 0);')
-            sql = sql.bindparams(account_id=account_id)
-            logging.debug(sql)
-            self.connection.execute(sql)
+        with self.engine.begin() as conn:
+            sql = text(_CREATE_ACCOUNTS_SQL)
+            sql = sql.bindparams(names=names)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('%s', sql)
+            account_ids = conn.execute(sql).scalars().all()
 
-    def transfer_funds(self, debit_account_id, credit_account_id, amount):
+        self._account_ids_cache = None
+        return account_ids
+
+    def _run_with_retries(self, transaction, autocommit=False):
         '''
-        Transfers funds between two accounts using double-entry bookkeeping.
-        Uses row-level locks and retries on deadlock.
+        Runs `transaction(conn)` inside its own database transaction and returns its result.
+        With `autocommit=True` no BEGIN/COMMIT is sent and every statement commits on its own;
+        this is only safe when `transaction` issues a single statement.
+        Retries when postgres aborts the transaction with a serialization failure or deadlock.
+        With ordered row locks at READ COMMITTED neither should normally happen,
+        so this is only a safety net.
         '''
 
-        MAX_RETRIES = 5
+        MAX_RETRIES = 10
         for attempt in range(MAX_RETRIES):
             try:
-                # Begin transaction
-                # Lock rows for update (row-level locks)
-                sql = text(f'SELECT balance FROM balances WHERE account_id = {debit_account_id} FOR UPDATE;')
-                logging.debug(sql)
-                results = self.connection.execute(sql)
-                debit_balance = results.first()[0]
-
-                sql = text(f'SELECT balance FROM balances WHERE account_id = {credit_account_id} FOR UPDATE;')
-                logging.debug(sql)
-                results = self.connection.execute(sql)
-                credit_balance = results.first()[0]
-
-                # Insert transaction record
-                sql = text(
-                    f'INSERT INTO transactions (debit_account_id, credit_account_id, amount) '
-                    f'VALUES ({debit_account_id}, {credit_account_id}, {amount});'
-                )
-                logging.debug(sql)
-                self.connection.execute(sql)
-
-                # Update balances
-                new_debit = debit_balance - amount
-                new_credit = credit_balance + amount
-
-                sql = text(f'UPDATE balances SET balance = {new_debit} WHERE account_id = {debit_account_id};')
-                logging.debug(sql)
-                self.connection.execute(sql)
-
-                sql = text(f'UPDATE balances SET balance = {new_credit} WHERE account_id = {credit_account_id};')
-                logging.debug(sql)
-                self.connection.execute(sql)
-
-                # Commit transaction
-                self.connection.commit()
-                break  # Success, break out of retry loop
+                with self.engine.connect() as conn:
+                    if autocommit:
+                        conn.execution_options(isolation_level='AUTOCOMMIT')
+                    with conn.begin():
+                        result = transaction(conn)
+
+                # Transaction is committed when the block exits
+                return result
 
             except sqlalchemy.exc.OperationalError as e:
-                self.connection.rollback()
-                logging.warning(f"Deadlock detected. Retry attempt {attempt + 1}...")
-                time.sleep(0.1 * (attempt + 1))  # Slight backoff
+                # conn.begin() has already rolled the transaction back
+                if not _is_retryable(e) or attempt == MAX_RETRIES - 1:
+                    raise
+                log.warning(f"Serialization failure or deadlock. Retry attempt {attempt + 1}...")
+                time.sleep(_backoff(attempt))
                 continue  # Try again
 
-            except Exception as e:
-                self.connection.rollback()
-                logging.error(f"Transfer failed: {e}")
-                raise
+    @staticmethod
+    def _lock_balances(conn, account_ids):
+        '''
+        Takes the row locks on the given accounts' balances in ascending account_id order.
+        Because every transfer acquires its locks in the same global order,
+        two transfers in opposite directions (A->B and B->A) can never deadlock.
+        The ORDER BY runs before the locking clause, so postgres locks the rows in sorted order.
+        This relies on READ COMMITTED: at SERIALIZABLE a transaction that waited on one of these locks
+        would be aborted with a serialization failure as soon as the holder committed.
+        FOR NO KEY UPDATE is enough because account_id never changes;
+        the lock still blocks every other transfer that wants to update the same balances.
+        '''
+        sql = text(_LOCK_BALANCES_SQL)
+        sql = sql.bindparams(account_ids=sorted(account_ids))
+        conn.execute(sql)
+
+    def transfer_funds(self, debit_account_id, credit_account_id, amount):
+        '''
+        Transfers funds between two accounts using double-entry bookkeeping.
+        All of the work is done by the transfer_funds() function defined in services/pg/sql/transfer_funds.sql,
+        which locks both balance rows in account_id order, updates them in place, and records the transaction.
+        A single function call is already atomic, so it runs on an AUTOCOMMIT connection:
+        no separate BEGIN and COMMIT are sent, and the transfer itself costs one round-trip
+        (plus the pool's pre-ping SELECT 1 when the connection is checked out).
+        There is no read-modify-write window.
+        Returns the transaction_id of the new transaction.
+        '''
+        def transaction(conn):
+            sql = text(_TRANSFER_FUNDS_SQL)
+            sql = sql.bindparams(dr=debit_account_id, cr=credit_account_id, amt=amount)
+            return conn.execute(sql).scalar()
+
+        return self._run_with_retries(transaction, autocommit=True)
+
+    def transfer_funds_batch(self, transfers):
+        '''
+        Performs many transfers inside a single transaction.
+        `transfers` is a list of (debit_account_id, credit_account_id, amount) tuples,
+        with the same meaning as the arguments to transfer_funds.
+
+        The debit, credit and amount columns are sent to postgres as three arrays,
+        and a single statement unnests them to insert every transaction record
+        and to apply the net change of every touched account with one UPDATE.
+        So the whole batch costs a fixed number of round-trips no matter how many transfers it contains.
+        Either every transfer in the batch is recorded or none of them are.
+        Like transfer_funds, the batch gives up after waiting 5s for a row lock.
+        '''
+        columns = _transfer_columns(transfers)
+        if not columns['drs']:
+            return
+
+        def transaction(conn):
+            conn.execute(text(_BATCH_LOCK_TIMEOUT_SQL))
+            self._lock_balances(conn, set(columns['drs']) | set(columns['crs']))
+
+            sql = text(_TRANSFER_FUNDS_BATCH_SQL)
+            sql = sql.bindparams(**columns)
+            conn.execute(sql)
 
+        self._run_with_retries(transaction)
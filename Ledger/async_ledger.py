@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import sqlalchemy.exc
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.sql import text
+from Ledger import (
+    log,
+    _GET_ALL_ACCOUNT_IDS_SQL,
+    _CREATE_ACCOUNT_SQL,
+    _CREATE_ACCOUNTS_SQL,
+    _LOCK_BALANCES_SQL,
+    _TRANSFER_FUNDS_SQL,
+    _TRANSFER_FUNDS_BATCH_SQL,
+    _transfer_columns,
+    _is_retryable,
+    _backoff,
+    _BATCH_LOCK_TIMEOUT_SQL,
+)
+
+
+class AsyncLedger:
+    '''
+    This class provides the same interface as Ledger, but every method is a coroutine.
+    It runs the same SQL with the same retry policy,
+    but talks to the database through asyncpg,
+    so a single process can keep many transfers in flight at once by running them with asyncio.gather:
+
+        ledger = AsyncLedger(url)
+        await asyncio.gather(*[ledger.transfer_funds(dr, cr, amt) for dr, cr, amt in transfers])
+
+    While one transfer is waiting on the network, the event loop sends the next one,
+    so throughput is no longer limited to one round-trip at a time.
+    '''
+
+    def __init__(self, url):
+        '''
+        The constructor creates a pool of asyncpg connections to the database.
+        The url may be a plain postgresql:// url; it is rewritten to use the asyncpg driver.
+        See Ledger.__init__ for the choice of isolation level.
+        '''
+        if url.startswith('postgresql://'):
+            url = url.replace('postgresql://', 'postgresql+asyncpg://', 1)
+        self.engine = create_async_engine(
+            url,
+            isolation_level='READ COMMITTED',
+            pool_size=20,
+            max_overflow=10,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+        )
+        self._account_ids_cache = None
+
+    async def get_all_account_ids(self):
+        '''
+        See Ledger.get_all_account_ids.
+        '''
+        if self._account_ids_cache is None:
+            async with self.engine.connect() as conn:
+                sql = text(_GET_ALL_ACCOUNT_IDS_SQL)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('%s', sql)
+                results = await conn.execute(sql)
+                self._account_ids_cache = results.scalars().all()
+        return list(self._account_ids_cache)
+
+    async def create_account(self, name):
+        '''
+        See Ledger.create_account.
+        '''
+        async with self.engine.begin() as conn:
+            sql = text(_CREATE_ACCOUNT_SQL)
+            sql = sql.bindparams(name=name)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('%s', sql)
+            account_id = (await conn.execute(sql)).scalar()
+
+        self._account_ids_cache = None
+        return account_id
+
+    async def create_accounts(self, names):
+        '''
+        See Ledger.create_accounts.
+        '''
+        names = list(names)
+        if not names:
+            return []
+
+        async with self.engine.begin() as conn:
+            sql = text(_CREATE_ACCOUNTS_SQL)
+            sql = sql.bindparams(names=names)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('%s', sql)
+            account_ids = (await conn.execute(sql)).scalars().all()
+
+        self._account_ids_cache = None
+        return account_ids
+
+    async def _run_with_retries(self, transaction, autocommit=False):
+        '''
+        See Ledger._run_with_retries.
+        '''
+        MAX_RETRIES = 10
+        for attempt in range(MAX_RETRIES):
+            try:
+                async with self.engine.connect() as conn:
+                    if autocommit:
+                        await conn.execution_options(isolation_level='AUTOCOMMIT')
+                    async with conn.begin():
+                        result = await transaction(conn)
+
+                # Transaction is committed when the block exits
+                return result
+
+            # Broader than Ledger's OperationalError: asyncpg's 40001/40P01 arrive as a generic DBAPIError
+            except sqlalchemy.exc.DBAPIError as e:
+                # conn.begin() has already rolled the transaction back
+                if not _is_retryable(e) or attempt == MAX_RETRIES - 1:
+                    raise
+                log.warning(f"Serialization failure or deadlock. Retry attempt {attempt + 1}...")
+                await asyncio.sleep(_backoff(attempt))
+                continue  # Try again
+
+    @staticmethod
+    async def _lock_balances(conn, account_ids):
+        '''
+        See Ledger._lock_balances.
+        '''
+        sql = text(_LOCK_BALANCES_SQL)
+        sql = sql.bindparams(account_ids=sorted(account_ids))
+        await conn.execute(sql)
+
+    async def transfer_funds(self, debit_account_id, credit_account_id, amount):
+        '''
+        See Ledger.transfer_funds.
+        '''
+        async def transaction(conn):
+            sql = text(_TRANSFER_FUNDS_SQL)
+            sql = sql.bindparams(dr=debit_account_id, cr=credit_account_id, amt=amount)
+            return (await conn.execute(sql)).scalar()
+
+        return await self._run_with_retries(transaction, autocommit=True)
+
+    async def transfer_funds_batch(self, transfers):
+        '''
+        See Ledger.transfer_funds_batch.
+        '''
+        columns = _transfer_columns(transfers)
+        if not columns['drs']:
+            return
+
+        async def transaction(conn):
+            await conn.execute(text(_BATCH_LOCK_TIMEOUT_SQL))
+            await self._lock_balances(conn, set(columns['drs']) | set(columns['crs']))
+
+            sql = text(_TRANSFER_FUNDS_BATCH_SQL)
+            sql = sql.bindparams(**columns)
+            await conn.execute(sql)
+
+        await self._run_with_retries(transaction)
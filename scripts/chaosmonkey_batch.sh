@@ -0,0 +1,24 @@
+#!/bin/sh
+
+# these lines ensure that any errors immediately kill the script and all children
+set -e
+trap "exit" INT TERM
+trap "kill 0" EXIT
+
+# get the url from the command line parameters
+url="$1"
+if [ -z "$url" ]; then
+    echo "ERROR: you must enter a database url to connect to for the test"
+    fail
+fi
+
+# randomly spawn and kill processes;
+# each process runs several threads that each commit batches of transfers
+pids=''
+for i in $(seq 1 10); do
+    echo "iteration $i"
+    python3 scripts/random_transfers.py $url --num_transfers=9999999999 --num_threads=8 --batch_size=10 &
+    pids="$pids $!"
+done
+sleep 10
+kill $pids
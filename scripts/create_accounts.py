@@ -11,6 +11,5 @@ if __name__ == '__main__':
 
     # generate accounts
     Ledger = Ledger.Ledger(args.db)
-    for i in range(args.num_accounts):
-        Ledger.create_account(f'test_account_{i:04}')
+    Ledger.create_accounts([f'test_account_{i:04}' for i in range(args.num_accounts)])
 
@@ -1,27 +1,71 @@
 import Ledger
 import random
 import argparse
+import concurrent.futures
+import sys
+
+
+def random_transfers(ledger, account_ids, num_transfers, batch_size):
+    '''
+    Performs `num_transfers` random transfers between the accounts in `account_ids`.
+    '''
+    batch = []
+    for i in range(num_transfers):
+        debit_account_id = random.choice(account_ids)
+        credit_account_id = debit_account_id
+        while debit_account_id == credit_account_id:
+            credit_account_id = random.choice(account_ids)
+        amount = random.randint(100, 1000)
+        if batch_size <= 1:
+            ledger.transfer_funds(debit_account_id, credit_account_id, amount)
+        else:
+            batch.append((debit_account_id, credit_account_id, amount))
+            if len(batch) >= batch_size:
+                ledger.transfer_funds_batch(batch)
+                batch = []
+    ledger.transfer_funds_batch(batch)
+
 
 if __name__ == '__main__':
 
     # process command line args
     parser = argparse.ArgumentParser()
     parser.add_argument('--num_transfers', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_threads', type=int, default=1)
     parser.add_argument('db')
     args = parser.parse_args()
+    if args.num_threads < 1:
+        parser.error('--num_threads must be at least 1')
 
     # get account_id list
-    Ledger = Ledger.Ledger(args.db)
-    account_ids = Ledger.get_all_account_ids()
+    ledger = Ledger.Ledger(args.db)
+    account_ids = ledger.get_all_account_ids()
     if len(account_ids) == 0:
         raise ValueError('No accounts in database.  Did you run create_accounts.py?')
 
-    # generate random transfers
-    for i in range(args.num_transfers):
-        debit_account_id = random.choice(account_ids)
-        credit_account_id = debit_account_id
-        while debit_account_id == credit_account_id:
-            credit_account_id = random.choice(account_ids)
-        amount = random.randint(100, 1000)
-        Ledger.transfer_funds(debit_account_id, credit_account_id, amount)
+    # generate random transfers;
+    # the Ledger checks a connection out of its pool for every transfer,
+    # so all of the threads can safely share it
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+        futures = [
+            executor.submit(
+                random_transfers,
+                ledger,
+                account_ids,
+                args.num_transfers // args.num_threads + (i < args.num_transfers % args.num_threads),
+                args.batch_size,
+            )
+            for i in range(args.num_threads)
+        ]
 
+    # a failed thread must fail the whole script, otherwise its transfers are silently dropped
+    failures = 0
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            Ledger.log.error(f'Transfer thread failed: {e!r}')
+            failures += 1
+    if failures:
+        sys.exit(f'{failures} of {args.num_threads} transfer threads failed')
@@ -0,0 +1,67 @@
+from Ledger.async_ledger import AsyncLedger
+from Ledger import log
+import asyncio
+import random
+import argparse
+
+
+async def main(args):
+
+    ledger = AsyncLedger(args.db)
+    try:
+
+        # get account_id list
+        account_ids = await ledger.get_all_account_ids()
+        if len(account_ids) == 0:
+            raise ValueError('No accounts in database.  Did you run create_accounts.py?')
+
+        # generate random transfers, keeping up to --concurrency of them in flight at once;
+        # a new transfer starts as soon as any running one finishes
+        semaphore = asyncio.Semaphore(args.concurrency)
+        failures = []
+        tasks = set()
+
+        async def transfer(debit_account_id, credit_account_id, amount):
+            try:
+                await ledger.transfer_funds(debit_account_id, credit_account_id, amount)
+            except Exception as e:
+                log.error(f'Transfer failed: {e!r}')
+                failures.append(e)
+            finally:
+                semaphore.release()
+
+        for i in range(args.num_transfers):
+            await semaphore.acquire()
+            if failures:
+                semaphore.release()
+                break
+            debit_account_id = random.choice(account_ids)
+            credit_account_id = debit_account_id
+            while debit_account_id == credit_account_id:
+                credit_account_id = random.choice(account_ids)
+            amount = random.randint(100, 1000)
+            task = asyncio.create_task(transfer(debit_account_id, credit_account_id, amount))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # wait for the transfers still in flight
+        await asyncio.gather(*tasks)
+        if failures:
+            raise failures[0]
+
+    finally:
+        await ledger.engine.dispose()
+
+
+if __name__ == '__main__':
+
+    # process command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_transfers', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('db')
+    args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+
+    asyncio.run(main(args))